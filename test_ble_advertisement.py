@@ -11,181 +11,210 @@ Usage:
 """
 
 import asyncio
+import logging
 import sys
+import time
 from bleak import BleakScanner
 from bleak.backends.scanner import AdvertisementData
+from bleak.exc import BleakError
 import struct
-from collections import defaultdict
-from datetime import datetime, timedelta
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
 
 # Advertisement chunking constants (must match Android implementation)
 MANUFACTURER_ID = 0xFFFF
 MAX_MESSAGE_DATA_BYTES = 24  # Max bytes per chunk for message data (reduced from 25 to 24 for messageID)
 CHUNK_TIMEOUT_SECONDS = 5  # Timeout for receiving all chunks
+PREVIEW_CHARS = 50  # Characters of the partial message shown in the live progress line
+_CHUNK_HEADER = struct.Struct('BB')  # chunk_index, total_chunks
+
+def _parse_chunk(raw: bytes) -> tuple[int, int, memoryview, int] | None:
+    """
+    Parse chunk from our manufacturer data payload.
+    Returns (chunk_index, total_chunks, message_data, message_id) or None if the payload is too short.
+    message_data is a zero-copy view into raw.
+    """
+    # Format: [chunk_index (1 byte), total_chunks (1 byte), message_data (up to 24 bytes), message_id (1 byte)]
+    if len(raw) < 3:  # At least chunk_index + total_chunks + message_id
+        return None
+    
+    chunk_index, total_chunks = _CHUNK_HEADER.unpack_from(raw, 0)
+    message_id = raw[-1]  # Last byte is messageID
+    message_data = memoryview(raw)[2:-1]  # Data between metadata and messageID
+    
+    return (chunk_index, total_chunks, message_data, message_id)
+
+def _scanner_kwargs() -> dict:
+    """
+    Extra BleakScanner arguments that push the manufacturer ID filter down to the OS.
+    On Linux, BlueZ passive scanning with an advertisement monitor pattern only reports
+    advertisements carrying our manufacturer data. Passive scanning sends no scan requests,
+    so data only carried in scan responses (often the local name) is not received.
+    Other backends have no equivalent, so they scan actively and rely on the check in
+    the detection callback.
+    """
+    if not sys.platform.startswith('linux'):
+        return {}
+    
+    try:
+        from bleak.assigned_numbers import AdvertisementDataType
+        try:
+            from bleak.args.bluez import BlueZScannerArgs, OrPattern
+        except ImportError:
+            # bleak < 1.0 keeps these in the BlueZ backend
+            from bleak.backends.bluezdbus.advertisement_monitor import OrPattern
+            from bleak.backends.bluezdbus.scanner import BlueZScannerArgs
+    except ImportError:
+        return {}
+    
+    # Manufacturer specific data starts with the little-endian company ID
+    pattern = OrPattern(0, AdvertisementDataType.MANUFACTURER_SPECIFIC_DATA, MANUFACTURER_ID.to_bytes(2, 'little'))
+    return {"scanning_mode": "passive", "bluez": BlueZScannerArgs(or_patterns=[pattern])}
+
+@dataclass(slots=True)
+class _DeviceState:
+    """Per-device reassembly state - one message in flight at a time"""
+    message_id: int  # current messageID being received
+    chunks: list[memoryview | None] | None = None  # slot per chunk_index, None when no message is in flight
+    received: int = 0  # number of filled chunk slots
+    prefix_buf: bytearray = field(default_factory=bytearray)  # bytes of the contiguous received prefix
+    prefix_end: int = 0  # index of the first chunk missing from the prefix
+    last_update: float = 0.0  # time.monotonic() of the last chunk of the partial message
+    completed_mask: int = 0  # 256-bit mask of completed messageIDs (bit N = messageID N)
+    
+    def clear_partial(self):
+        """Discard the partial message, keeping messageID and completion history"""
+        self.chunks = None
+        self.received = 0
+        self.prefix_buf = bytearray()
+        self.prefix_end = 0
 
 class MessageReconstructor:
     """Reconstructs full messages from advertisement chunks with messageID tracking"""
     
     def __init__(self, timeout_seconds=CHUNK_TIMEOUT_SECONDS):
-        self.chunks: defaultdict[str, dict[int, tuple[bytes, int]]] = defaultdict(dict)  # device -> chunk_index -> (data, messageId)
-        self.chunk_timestamps: defaultdict[str, dict[int, datetime]] = defaultdict(dict)
-        self.current_message_ids: dict[str, int] = {}  # device -> current messageID being received
-        self.completed_message_ids: defaultdict[str, set[int]] = defaultdict(set)  # device -> set of completed messageIDs
-        self.current_messages: dict[str, str] = {}  # device -> current partial message (for live display)
+        self.devices: dict[str, _DeviceState] = {}  # device -> reassembly state
         self.timeout_seconds = timeout_seconds
     
-    def add_chunk(self, device_address: str, chunk_index: int, total_chunks: int, data: bytes, message_id: int) -> tuple[str | None, bool]:
+    def add_chunk(self, device_address: str, chunk_index: int, total_chunks: int, data: bytes | memoryview, message_id: int) -> tuple[str | None, bool]:
         """
         Add a chunk and return (full_message, is_new_message) if all chunks are received.
         Returns (None, False) if message is not complete yet.
         Second return value indicates if this is a new unique message (not a duplicate).
         """
-        now = datetime.now()
+        now = time.monotonic()
+        state = self.devices.get(device_address)
         
         # FIRST: Check if we've already completed this message - ignore completely
-        if message_id in self.completed_message_ids[device_address]:
+        if state is not None and (state.completed_mask >> message_id) & 1:
             # Ignore duplicate message - don't process at all
             return (None, False)
         
-        # Check if messageID changed - if so, clear buffer and start new message
-        if device_address in self.current_message_ids:
-            if self.current_message_ids[device_address] != message_id:
-                print(f"🔄 [{device_address}] MessageID changed: {self.current_message_ids[device_address]} -> {message_id}. Clearing buffer.")
-                self.chunks[device_address].clear()
-                self.chunk_timestamps[device_address].clear()
-                self.current_messages[device_address] = ""
+        # Chunk index outside the announced total - malformed, ignore
+        if chunk_index >= total_chunks:
+            return (None, False)
         
-        # Update current messageID
-        self.current_message_ids[device_address] = message_id
+        if state is None:
+            state = self.devices[device_address] = _DeviceState(message_id)
+        elif state.message_id != message_id:
+            # MessageID changed - clear buffer and start new message
+            print(f"🔄 [{device_address}] MessageID changed: {state.message_id} -> {message_id}. Clearing buffer.")
+            state.clear_partial()
+            state.message_id = message_id
         
-        # Store chunk (with messageID)
-        self.chunks[device_address][chunk_index] = (data, message_id)
-        self.chunk_timestamps[device_address][chunk_index] = now
+        # Single-chunk message - nothing to reassemble, decode it right away
+        if total_chunks == 1:
+            return self._complete_message(state, device_address, bytes(data), message_id)
         
-        # Update current message for live display
-        message_parts = []
-        for i in sorted(self.chunks[device_address].keys()):
-            chunk_data, _ = self.chunks[device_address][i]
-            message_parts.append(chunk_data)
+        # One message is in flight per device - if it went quiet past the timeout, start over
+        self._cleanup_old_chunks(state, now)
         
-        try:
-            partial_message = b''.join(message_parts).decode('utf-8', errors='replace')
-            self.current_messages[device_address] = partial_message
-        except:
-            pass
+        # Total changed under the same messageID (sender restarted or the ID wrapped) - start a new message
+        if state.chunks is not None and len(state.chunks) != total_chunks:
+            state.clear_partial()
+        
+        # Store chunk in its slot, preallocated once total_chunks is known
+        slots = state.chunks
+        if slots is None:
+            slots = state.chunks = [None] * total_chunks
+        previous = slots[chunk_index]
+        if previous is None:
+            state.received += 1
+        elif chunk_index < state.prefix_end and previous != data:
+            # Chunk changed after the prefix copied it - cut the prefix back so the new bytes are used
+            del state.prefix_buf[sum(len(chunk) for chunk in slots[:chunk_index]):]
+            state.prefix_end = chunk_index
+        slots[chunk_index] = data
+        state.last_update = now
         
-        # Check for old chunks and remove them
-        self._cleanup_old_chunks(device_address, now)
+        # Extend the contiguous prefix only when this chunk fills the gap at its end
+        prefix_end = state.prefix_end
+        if chunk_index == prefix_end:
+            prefix_buf = state.prefix_buf
+            while prefix_end < len(slots) and slots[prefix_end] is not None:
+                prefix_buf.extend(slots[prefix_end])
+                prefix_end += 1
+            state.prefix_end = prefix_end
         
         # Check if we have all chunks
-        if len(self.chunks[device_address]) == total_chunks:
-            # Double-check we haven't completed this messageID already (race condition protection)
-            if message_id in self.completed_message_ids[device_address]:
-                # Already completed, ignore and clear any stale chunks
-                if device_address in self.chunks:
-                    self.chunks[device_address].clear()
-                if device_address in self.chunk_timestamps:
-                    self.chunk_timestamps[device_address].clear()
-                return (None, False)
+        if state.received == total_chunks:
+            # Reconstruct message - the prefix buffer already holds every chunk in order,
+            # and all of them share message_id because the slots are cleared when it changes
+            return self._complete_message(state, device_address, state.prefix_buf, message_id)
+        
+        return (None, False)  # Message not complete yet
+    
+    def _complete_message(self, state: _DeviceState, device_address: str, full_message_bytes: bytes | bytearray, message_id: int) -> tuple[str | None, bool]:
+        """Decode a fully received message and mark its messageID as completed"""
+        try:
+            # Plain ASCII payloads (the common case for chat text) take the cheaper codec
+            if full_message_bytes.isascii():
+                message = full_message_bytes.decode('ascii')
+            else:
+                message = full_message_bytes.decode('utf-8')
             
-            # Verify we have all chunks from 0 to total_chunks-1 with same messageID
-            chunks_list = []
-            valid_chunks = True
-            for i in range(total_chunks):
-                if i not in self.chunks[device_address]:
-                    # Missing chunk - not ready yet
-                    valid_chunks = False
-                    break
-                chunk_data, chunk_message_id = self.chunks[device_address][i]
-                if chunk_message_id != message_id:
-                    # Different messageID - invalid, clear and ignore
-                    print(f"⚠️ [{device_address}] Chunk {i} has different messageID ({chunk_message_id} vs {message_id}). Clearing.")
-                    self.chunks[device_address].clear()
-                    self.chunk_timestamps[device_address].clear()
-                    valid_chunks = False
-                    break
-                chunks_list.append(chunk_data)
+            # Mark message as completed IMMEDIATELY (before clearing chunks) - this is critical!
+            state.completed_mask |= 1 << message_id
             
-            if not valid_chunks:
-                return (None, False)
+            # Clear chunks for this device AFTER marking as completed
+            # Keep message_id to track the last messageID we saw
+            state.clear_partial()
             
-            # Reconstruct message
-            full_message_bytes = b''.join(chunks_list)
-            try:
-                message = full_message_bytes.decode('utf-8')
-                
-                # Mark message as completed IMMEDIATELY (before clearing chunks) - this is critical!
-                self.completed_message_ids[device_address].add(message_id)
-                
-                # Clear chunks for this device AFTER marking as completed
-                if device_address in self.chunks:
-                    del self.chunks[device_address]
-                if device_address in self.chunk_timestamps:
-                    del self.chunk_timestamps[device_address]
-                if device_address in self.current_messages:
-                    del self.current_messages[device_address]
-                # Keep current_message_ids to track the last messageID we saw
-                
-                return (message, True)  # New unique message
-            except UnicodeDecodeError as e:
-                print(f"❌ Error decoding message from {device_address}: {e}")
-                # Clear invalid chunks
-                if device_address in self.chunks:
-                    self.chunks[device_address].clear()
-                if device_address in self.chunk_timestamps:
-                    self.chunk_timestamps[device_address].clear()
-                return (None, False)
-        
-        return (None, False)  # Message not complete yet
+            return (message, True)  # New unique message
+        except UnicodeDecodeError as e:
+            print(f"❌ Error decoding message from {device_address}: {e}")
+            # Clear invalid chunks
+            state.clear_partial()
+            return (None, False)
     
-    def _cleanup_old_chunks(self, device_address: str, now: datetime):
-        """Remove chunks older than timeout"""
-        if device_address not in self.chunk_timestamps:
-            return
-        
-        chunks_to_remove = []
-        for chunk_index, timestamp in self.chunk_timestamps[device_address].items():
-            if (now - timestamp).total_seconds() > self.timeout_seconds:
-                chunks_to_remove.append(chunk_index)
-        
-        for chunk_index in chunks_to_remove:
-            del self.chunks[device_address][chunk_index]
-            del self.chunk_timestamps[device_address][chunk_index]
+    def _cleanup_old_chunks(self, state: _DeviceState, now: float):
+        """Drop the partial message if nothing has arrived for it within the timeout"""
+        if state.chunks is not None and now - state.last_update > self.timeout_seconds:
+            state.clear_partial()
+    
+    def get_current_message(self, device_address: str) -> str:
+        """Decode the start of the contiguous received prefix for live display"""
+        state = self.devices.get(device_address)
+        if state is None:
+            return ""
         
-        # If no chunks left, remove device entry
-        if not self.chunks[device_address]:
-            del self.chunks[device_address]
-            if device_address in self.chunk_timestamps:
-                del self.chunk_timestamps[device_address]
+        # A UTF-8 character is at most 4 bytes, so this slice always covers PREVIEW_CHARS characters
+        preview = state.prefix_buf[:PREVIEW_CHARS * 4].decode('utf-8', errors='replace')
+        return preview[:PREVIEW_CHARS]
 
 class BLETestClient:
     def __init__(self):
         self.reconstructor = MessageReconstructor()
         self.received_messages: list[tuple[str, str, datetime]] = []  # (device_address, message, timestamp)
-        self.received_message_keys: set[tuple[str, int]] = set()  # (device_address, message_id) - track what we've displayed
-        
-    def parse_advertisement_chunk(self, device_address: str, manufacturer_data: dict) -> tuple[int, int, bytes, int] | None:
-        """
-        Parse chunk from manufacturer data.
-        Returns (chunk_index, total_chunks, message_data, message_id) or None if not our data.
-        """
-        # Look for our manufacturer ID (0xFFFF)
-        if MANUFACTURER_ID not in manufacturer_data:
-            return None
-        
-        data = manufacturer_data[MANUFACTURER_ID]
-        
-        # Format: [chunk_index (1 byte), total_chunks (1 byte), message_data (up to 24 bytes), message_id (1 byte)]
-        if len(data) < 3:  # At least chunk_index + total_chunks + message_id
-            return None
-        
-        chunk_index = data[0]
-        total_chunks = data[1]
-        message_id = data[-1]  # Last byte is messageID
-        message_data = data[2:-1] if len(data) > 3 else b''  # Data between metadata and messageID
+        self.received_per_device: dict[str, int] = {}  # device_address -> 256-bit mask of displayed messageIDs (bit N = messageID N)
+        self._last_seen: dict[str, bytes] = {}  # device_address -> raw manufacturer payload of the last advertisement
+        self._queue: deque[tuple[str, bytes, str | None, int]] = deque()  # (device_address, raw, local_name, rssi) awaiting processing
+        self._event = asyncio.Event()  # set when new advertisements are queued
         
-        return (chunk_index, total_chunks, message_data, message_id)
-    
     async def scan_for_devices(self, timeout=30.0):
         """Scan for BLE devices with chunked advertisements"""
         print("🔍 Scanning for BLE devices with chunked advertisements...")
@@ -199,100 +228,137 @@ class BLETestClient:
         print()
         
         devices_found = set()
-        last_display_time = {}
+        loop = asyncio.get_running_loop()
+        display_cooldown: set[str] = set()  # devices whose progress line was shown within the last display_interval
         display_interval = 0.5  # Update display every 0.5 seconds
+        pending_progress: list[str] = []  # progress lines written out once per drain pass
+        
+        def flush_progress():
+            if pending_progress:
+                sys.stdout.write(''.join(pending_progress))
+                sys.stdout.flush()
+                pending_progress.clear()
         
         def detection_callback(device, advertisement_data: AdvertisementData):
+            # Check for our manufacturer data
+            raw = advertisement_data.manufacturer_data.get(MANUFACTURER_ID)
+            if raw is None:
+                return
+            
+            # Advertisements are repeated by design - skip a payload identical to the last one from this device
+            address = device.address
+            if self._last_seen.get(address) == raw:
+                return
+            self._last_seen[address] = raw
+            
+            # Defer parsing to the drain task so a burst of advertisements is handled in one pass
+            self._queue.append((address, raw, advertisement_data.local_name, advertisement_data.rssi))
+            self._event.set()
+        
+        def process_advertisement(address: str, raw: bytes, local_name: str | None, rssi: int):
             try:
-                # Check for manufacturer data
-                if not advertisement_data.manufacturer_data:
-                    return
-                
                 # Parse chunk
-                chunk_info = self.parse_advertisement_chunk(device.address, advertisement_data.manufacturer_data)
+                chunk_info = _parse_chunk(raw)
                 if chunk_info is None:
                     return
                 
                 chunk_index, total_chunks, message_data, message_id = chunk_info
-                device_name = advertisement_data.local_name or device.address
-                
-                # Create message key for duplicate detection
-                message_key = (device.address, message_id)
+                device_name = local_name or address
                 
                 # Check if we've already displayed this exact message (early exit)
-                if message_key in self.received_message_keys:
+                if (self.received_per_device.get(address, 0) >> message_id) & 1:
                     # Already displayed - skip completely
                     return
                 
-                # Check if this messageID was already completed (early exit to avoid processing)
-                # This MUST be checked before calling add_chunk to prevent any processing of duplicates
-                if message_id in self.reconstructor.completed_message_ids[device.address]:
-                    # Mark as displayed to prevent future processing
-                    self.received_message_keys.add(message_key)
-                    # Skip processing duplicate messages completely - return immediately
-                    return
-                
-                # Add chunk to reconstructor
+                # Add chunk to reconstructor (it ignores messageIDs that were already completed)
                 message, is_new_message = self.reconstructor.add_chunk(
-                    device.address,
+                    address,
                     chunk_index,
                     total_chunks,
                     message_data,
                     message_id
                 )
                 
-                # Check if completed (may have been completed during add_chunk)
-                is_now_completed = message_id in self.reconstructor.completed_message_ids[device.address]
-                
-                if message and is_new_message and is_now_completed:
-                    # Double-check we haven't displayed this (race condition protection)
-                    if message_key in self.received_message_keys:
-                        # Already displayed - skip
-                        return
+                if message and is_new_message:
+                    # Mark as displayed
+                    self.received_per_device[address] = self.received_per_device.get(address, 0) | (1 << message_id)
                     
-                    # Mark as displayed BEFORE printing (prevents race conditions)
-                    self.received_message_keys.add(message_key)
-                    
-                    # Full message reconstructed!
+                    # Full message reconstructed! Write out earlier progress first to keep output in order
+                    flush_progress()
                     timestamp = datetime.now()
-                    self.received_messages.append((device.address, message, timestamp))
+                    self.received_messages.append((address, message, timestamp))
                     
-                    print(f"\n✅ NEW MESSAGE from {device_name} ({device.address}) [messageID={message_id}]:")
+                    print(f"\n✅ NEW MESSAGE from {device_name} ({address}) [messageID={message_id}]:")
                     print(f"   {message}")
                     print(f"   ({len(message)} chars, {total_chunks} chunks)")
                     print()
                     
-                    if device.address not in devices_found:
-                        devices_found.add(device.address)
-                        print(f"📱 Device: {device_name} ({device.address})")
-                        print(f"   RSSI: {advertisement_data.rssi}")
+                    if address not in devices_found:
+                        devices_found.add(address)
+                        print(f"📱 Device: {device_name} ({address})")
+                        print(f"   RSSI: {rssi}")
                         print()
-                elif not is_now_completed:
-                    # Partial message - show live progress only if not completed
-                    # Check if we have chunks (may have been cleared if message was completed)
-                    if device.address in self.reconstructor.chunks:
-                        chunks_received = len(self.reconstructor.chunks[device.address])
-                        current_message = self.reconstructor.current_messages.get(device.address, "")
-                        
-                        # Only show progress if we have chunks
-                        if chunks_received > 0:
-                            # Throttle display updates
-                            now = datetime.now()
-                            last_time = last_display_time.get(device.address)
-                            if last_time is None or (now - last_time).total_seconds() >= display_interval:
-                                last_display_time[device.address] = now
-                                
-                                # Clear line and show progress (for live updates)
-                                print(f"\r📦 [{device_name}] Chunk {chunk_index + 1}/{total_chunks} ({chunks_received}/{total_chunks}) [ID={message_id}] | Current: {current_message[:50]}", end="", flush=True)
-                # If is_now_completed is True and we don't have a message, it means it was a duplicate - silently ignore
+                else:
+                    # Partial message - show live progress
+                    # Check if we have chunks (cleared once a message completes or is a duplicate)
+                    state = self.reconstructor.devices.get(address)
+                    chunks_received = state.received if state is not None else 0
+                    
+                    # Only show progress if we have chunks
+                    if chunks_received > 0:
+                        # Throttle display updates - a timer lifts the cooldown, so no clock read per advertisement
+                        if address not in display_cooldown:
+                            display_cooldown.add(address)
+                            loop.call_later(display_interval, display_cooldown.discard, address)
+                            
+                            # Decode the partial message only when it is actually shown
+                            current_message = self.reconstructor.get_current_message(address)
+                            
+                            # Clear line and show progress (for live updates)
+                            pending_progress.append(f"\r📦 [{device_name}] Chunk {chunk_index + 1}/{total_chunks} ({chunks_received}/{total_chunks}) [ID={message_id}] | Current: {current_message}")
                     
             except Exception as e:
                 print(f"\n❌ Error processing advertisement: {e}")
-                import traceback
-                traceback.print_exc()
+                log.exception("Error processing advertisement from %s", address)
+        
+        def drain_queue():
+            while self._queue:
+                process_advertisement(*self._queue.popleft())
+            flush_progress()
+        
+        async def drain():
+            while True:
+                await self._event.wait()
+                self._event.clear()
+                drain_queue()
+        
+        drain_task = asyncio.create_task(drain())
+        try:
+            scanner_kwargs = _scanner_kwargs()
+            scanner = BleakScanner(detection_callback=detection_callback, **scanner_kwargs)
+            try:
+                await scanner.start()
+            except BleakError as e:
+                # Passive scanning needs BlueZ advertisement monitor support (experimental features)
+                if not scanner_kwargs:
+                    raise
+                print(f"⚠️ Filtered passive scanning unavailable ({e}). Falling back to active scanning.")
+                scanner = BleakScanner(detection_callback=detection_callback)
+                await scanner.start()
+            
+            try:
+                await asyncio.sleep(timeout)
+            finally:
+                await scanner.stop()
+        finally:
+            drain_task.cancel()
+            try:
+                await drain_task
+            except asyncio.CancelledError:
+                pass
         
-        async with BleakScanner(detection_callback=detection_callback):
-            await asyncio.sleep(timeout)
+        # Process anything that arrived after the last drain pass
+        drain_queue()
         
         return list(devices_found)
 